@@ -1,21 +1,42 @@
-from sys import argv
-from urllib import request
+import logging
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from http.client import HTTPSConnection
+from sys import argv, stdout
 from vanet.vehicle import FleetVehicle, LeadVehicle
 
+# Keep-alive connection to the address service, reused across lookups to avoid repeated TCP and TLS handshakes
+_ADDRESS_SERVICE = HTTPSConnection("checkip.amazonaws.com")
 
+
+@lru_cache(maxsize=1)
 def get_external_address():
     # Gather source address of lead vehicle using external service (without using requests module or upnp)
-    req = request.Request("https://checkip.amazonaws.com/")
-    res = request.urlopen(req)
-    return str(res.read().decode('utf-8')).strip('\n')
+    # The address does not change while we run, so the lookup is cached and only performed once per process
+    _ADDRESS_SERVICE.request("GET", "/")
+    res = _ADDRESS_SERVICE.getresponse()
+    body = res.read()
+
+    # Error pages must raise before lru_cache can keep their body as the address for the rest of the run
+    if res.status != 200:
+        raise ConnectionError(f"Address lookup failed with HTTP {res.status} {res.reason}.")
+    return body.decode().strip()
 
 
 def initialize_fleet(*, num_vehicles: int = 1, port: int):
     """ Allows us to create n-number of vehicles that follow behind lead vehicle. """
+    # An empty fleet needs no address, skip the network lookup entirely
+    if num_vehicles <= 0:
+        return []
+
+    # Resolve address once up front so every vehicle shares the cached value
+    address = get_external_address()
+
     vehicles = []
     for i in range(0, num_vehicles):
         vehicles.append(
-            FleetVehicle((get_external_address(), port))
+            FleetVehicle((address, port))
         )
     return vehicles
 
@@ -34,9 +55,19 @@ if __name__ == "__main__":
         # Run lead on remote machine and broadcast on port 9999
         python3 lead <REMOTE_IP_ADDRESS> 9999
     """
-    vals = argv[1:]
-    if vals[0] == "lead":
-        lead = LeadVehicle(get_external_address(), [(str(vals[1]), int(vals[2]))])
-    else:
-        initialize_fleet(num_vehicles=1, port=int(vals[1]))
+    # Per-packet transmission details are logged at debug level, lower the level to DEBUG to print them
+    # Vehicles format and enqueue records on their own thread, a background listener performs the console writes
+    log_queue = SimpleQueue()
+    log_listener = QueueListener(log_queue, logging.StreamHandler(stdout))
+    logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[QueueHandler(log_queue)])
+    log_listener.start()
+
+    try:
+        vals = argv[1:]
+        if vals[0] == "lead":
+            lead = LeadVehicle(get_external_address(), [(str(vals[1]), int(vals[2]))])
+        else:
+            initialize_fleet(num_vehicles=1, port=int(vals[1]))
+    finally:
+        log_listener.stop()
     print("\nVANET Transmission Ended")
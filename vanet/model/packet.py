@@ -1,26 +1,50 @@
-import datetime
-from typing import ClassVar
-from pydantic import BaseModel, validator, ValidationError, root_validator, Field
+import logging
+import struct
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Optional
 from ipaddress import IPv4Address
-import json
+from socket import inet_aton, inet_ntoa
 
+logger = logging.getLogger(__name__)
 
-class Coordinates(BaseModel):
+# Binary wire layout (little endian, no padding):
+#   MAGIC (4 bytes) | CHK (uint32, CRC-32 of everything after it) | SEQ (uint16) | SRC (4 bytes, packed IPv4)
+#   CLK | GPS longitude | GPS latitude | BRK | GAS | ACC | VEL (float64 each)
+PACKET_MAGIC = b'VNET'
+_WIRE_FORMAT = struct.Struct('<4sIH4s7d')
+_CHECKSUM_FORMAT = struct.Struct('<I')
+_CHECKSUM_OFFSET = len(PACKET_MAGIC)
+_BODY_OFFSET = _CHECKSUM_OFFSET + _CHECKSUM_FORMAT.size
+
+# Addresses that can never identify a transmitting vehicle
+_RESERVED_SOURCES = frozenset((IPv4Address('0.0.0.0'), IPv4Address('255.255.255.255')))
+
+# Received packets handed back through Packet.release, reused by interpret_packet instead of allocating
+_PACKET_POOL = []
+
+# Largest datagram a packet may occupy on the wire, used to size send and receive buffers
+MAX_PACKET_SIZE = _WIRE_FORMAT.size
+
+# Acknowledgement layout (little endian): MAGIC (4 bytes) | SEQ (uint16)
+ACK_MAGIC = b'ACK '
+ACK_FORMAT = struct.Struct('<4sH')
+
+
+@dataclass(slots=True)
+class Coordinates:
     """ Defines coordinate format and significant """
     longitude: float
     latitude: float
 
-    @validator('longitude')
-    def check_longitude_values(cls, v):
-        if v > 180 or v < -180:
-            raise ValidationError("Longitude values must be between [-180, 180].")
-        return v.__round__(5)
-
-    @validator('latitude')
-    def check_latitude_values(cls, v):
-        if v > 90 or v < -90:
-            raise ValidationError("Latitude values must be between [-90, 90].")
-        return v.__round__(5)
+    def __post_init__(self):
+        # Range check and rounding for both axes in one pass, using the builtin round over the dunder lookup
+        if not -180 <= self.longitude <= 180:
+            raise ValueError("Longitude values must be between [-180, 180].")
+        if not -90 <= self.latitude <= 90:
+            raise ValueError("Latitude values must be between [-90, 90].")
+        self.longitude, self.latitude = round(self.longitude, 5), round(self.latitude, 5)
 
     def __str__(self):
         return f"[{self.longitude}, {self.latitude}]"
@@ -29,109 +53,110 @@ class Coordinates(BaseModel):
         return f"[{self.longitude}, {self.latitude}]"
 
 
-class Packet(BaseModel):
+@dataclass(slots=True)
+class Packet:
     """
     Valid Values:
         SequenceNumber:     0           -> 9999
-        SourceAddress:      0.0.0.0     -> 255.255.255.255
+        SourceAddress:      0.0.0.1     -> 255.255.255.254
         GPSPosition:        [-180, -90] -> [180, 90]
         Velocity:           0.00        -> 300.00
         Acceleration:       -15 m/s^2   -> 15 m/s^2
         BrakeControl:       0           -> 100
         GasThrottle:        0           -> 100
     """
-    timestamp: float = None
     sequence_number: int
-    source_address: IPv4Address
+    source_address: str
     gps_position: Coordinates
     velocity: float
     acceleration: float
     brake_control: float
     gas_throttle: float
+    timestamp: Optional[float] = None
 
     # VALIDATORS
 
-    @validator("sequence_number")
-    def check_valid_sequence(cls, v, values):
-        if v < 0 or v > 9999:
-            raise ValidationError("Packet sequences should be between 0 and 9999.")
-        return v
-
-    @validator("velocity")
-    def check_velocity_range(cls, v):
-        if v < 0 or v > 300:
-            raise ValidationError("Velocity should be between 0 and 300 kph.")
-        return v
-
-    @validator("acceleration")
-    def check_acceleration_range(cls, v):
-        if v < -15 or v > 15:
-            raise ValidationError("Acceleration should be between -15 and 15 m/s^2.")
-        return v
-
-    @validator("brake_control", "gas_throttle")
-    def check_pedal_ranges(cls, v):
-        if v < 0 or v > 100:
-            raise ValidationError("Pedal values should be between 0 and 100.")
-        return v
+    def __post_init__(self):
+        # All range checks run once on construction instead of through per-field validator dispatch
+        if self.sequence_number < 0 or self.sequence_number > 9999:
+            raise ValueError("Packet sequences should be between 0 and 9999.")
+        if self.velocity < 0 or self.velocity > 300:
+            raise ValueError("Velocity should be between 0 and 300 kph.")
+        if self.acceleration < -15 or self.acceleration > 15:
+            raise ValueError("Acceleration should be between -15 and 15 m/s^2.")
+        if self.brake_control < 0 or self.brake_control > 100 or self.gas_throttle < 0 or self.gas_throttle > 100:
+            raise ValueError("Pedal values should be between 0 and 100.")
+
+        # Addresses are kept as plain strings, parsing only to reject malformed or non-routable values
+        address = IPv4Address(self.source_address)
+        if address in _RESERVED_SOURCES:
+            raise ValueError("Source address cannot be the unspecified or broadcast address.")
+        self.source_address = str(address)
 
     # GENERATORS
 
-    @staticmethod
-    def _calculate_checksum(data: str):
-        checksum = 0
-        for c in data:
-            checksum += ord(c)
-        return str(checksum)
-
     @staticmethod
     def interpret_packet(data: bytes):
-        values = bytes.decode(data, 'utf-8').split('\n')
-        pkt_dict = {}
-        for item in values:
-            k, _, v = item.partition(": ")
-            if k == "GPS":
-                v = json.loads(v)
-            pkt_dict[k.lower()] = v
         try:
-            new_packet = Packet(
-                sequence_number=int(pkt_dict['seq']),
-                source_address=IPv4Address(pkt_dict['src']),
-                gps_position=Coordinates(longitude=float(pkt_dict['gps'][0]), latitude=float(pkt_dict['gps'][1])),
-                velocity=pkt_dict['vel'],
-                acceleration=pkt_dict['acc'],
-                brake_control=pkt_dict['brk'],
-                gas_throttle=pkt_dict['gas'],
-                timestamp=pkt_dict['clk']
+            if len(data) != _WIRE_FORMAT.size:
+                raise ValueError(f"Expected {_WIRE_FORMAT.size} bytes, received {len(data)}.")
+            magic, checksum, sequence, source, clock, longitude, latitude, brake, gas, acceleration, velocity = \
+                _WIRE_FORMAT.unpack_from(data)
+            if magic != PACKET_MAGIC:
+                raise ValueError("Missing packet header.")
+            if checksum != zlib.crc32(memoryview(data)[_BODY_OFFSET:]):
+                raise ValueError("Checksum mismatch.")
+
+            # Recycle a released packet when one is available, re-running __init__ revalidates it in place. Fleet
+            # vehicles share the pool across threads, so pop atomically and fall back on an empty pool
+            try:
+                new_packet = _PACKET_POOL.pop()
+            except IndexError:
+                new_packet = object.__new__(Packet)
+            gps_position = getattr(new_packet, 'gps_position', None) or object.__new__(Coordinates)
+            gps_position.__init__(longitude=longitude, latitude=latitude)
+            new_packet.__init__(
+                sequence_number=sequence,
+                source_address=inet_ntoa(source),
+                gps_position=gps_position,
+                velocity=velocity,
+                acceleration=acceleration,
+                brake_control=brake,
+                gas_throttle=gas,
+                timestamp=clock
             )
         except Exception as e:
-            print(f"Corrupted packet: {str(e)}")
+            logger.warning("Corrupted packet: %s", e)
             return None
         return new_packet
 
+    def release(self):
+        """ Return a received packet to the pool once the caller no longer references it. """
+        _PACKET_POOL.append(self)
+
     def get_packet(self) -> bytes:
+        buffer = bytearray(_WIRE_FORMAT.size)
+        self.pack_into(buffer)
+        return bytes(buffer)
+
+    def pack_into(self, buffer: bytearray) -> int:
+        """ Write the encoded packet into a preallocated buffer and return the number of bytes written. """
         # Timestamp packet
-        self.timestamp = datetime.datetime.utcnow().timestamp()
-
-        # Recreate all packet values
-        unprocessed_packet = \
-f'''VANET-V2V
-SEQ: {self.sequence_number}
-SRC: {self.source_address}
-CHK: $SENTINEL$
-CLK: {self.timestamp}
-GPS: {self.gps_position}
-BRK: {self.brake_control}
-GAS: {self.gas_throttle}
-ACC: {self.acceleration}
-VEL: {self.velocity}'''
-
-        # Calculate checksum and insert
-        cleartext_packet_data = unprocessed_packet.replace('$SENTINEL$', self._calculate_checksum(unprocessed_packet))
-
-        # Encode packet
-        encoded_packet_data = bytes(cleartext_packet_data, 'utf-8')
-        return encoded_packet_data
-
-    class Config:
-        validate_assignment = True
+        self.timestamp = time.time()
+
+        values = (
+            self.sequence_number,
+            inet_aton(self.source_address),
+            self.timestamp,
+            self.gps_position.longitude,
+            self.gps_position.latitude,
+            self.brake_control,
+            self.gas_throttle,
+            self.acceleration,
+            self.velocity
+        )
+
+        # Pack with an empty checksum, then checksum every field that follows it straight out of the buffer
+        _WIRE_FORMAT.pack_into(buffer, 0, PACKET_MAGIC, 0, *values)
+        _CHECKSUM_FORMAT.pack_into(buffer, _CHECKSUM_OFFSET, zlib.crc32(memoryview(buffer)[_BODY_OFFSET:_WIRE_FORMAT.size]))
+        return _WIRE_FORMAT.size
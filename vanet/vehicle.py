@@ -1,17 +1,48 @@
-import datetime
+import logging
+import platform
 import random
+import selectors
+import sys
 import threading
 import time
-from socket import socket, AF_INET, SOCK_DGRAM
+from socket import socket, getaddrinfo, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_SNDBUF, SO_RCVBUF, IPPROTO_IP, IP_TOS
 from typing import List
 
-from vanet.model.packet import Packet, Coordinates
-from ipaddress import IPv4Address
+from vanet.model.packet import Packet, Coordinates, MAX_PACKET_SIZE, PACKET_MAGIC, ACK_MAGIC, ACK_FORMAT
+
+try:
+    from socket import SO_BUSY_POLL, SO_PREFER_BUSY_POLL
+except ImportError:
+    # Not exported by the socket module, use the asm-generic/socket.h numbers only on Linux architectures built from
+    # that header (alpha, mips, parisc and sparc number their options differently), elsewhere busy polling is skipped
+    if sys.platform.startswith("linux") and platform.machine() in (
+        "x86_64", "i386", "i686", "aarch64", "armv6l", "armv7l", "riscv64", "ppc64", "ppc64le", "s390x", "loongarch64"
+    ):
+        SO_BUSY_POLL, SO_PREFER_BUSY_POLL = 46, 69
+    else:
+        SO_BUSY_POLL = SO_PREFER_BUSY_POLL = None
+
+logger = logging.getLogger(__name__)
 
 MAX_TRAVEL_DELTA = 2.5      # Max number of coordinate points traveled in a single trip (variation)
 MAX_VELOCITY     = 300      # Max velocity in Kilometers per hour, to facilitate equaltion calculations
 MAX_ACCELERATION = 10       # Max acceleration in m/s^2, eases math calculations
 SAMPLE_RATE      = 2        # Frequency of packet transmissions in Hertz
+PEDAL_CHANCE     = 0.15 / (0.15 + 0.97)  # Chance the driver changes pedal inputs on a sensor update
+ACK_TIMEOUT      = 1        # Seconds the lead waits for an acknowledgement before moving on
+SOCKET_BUFFER    = 1 << 20  # Send and receive buffer size in bytes, capped by net.core.wmem_max/rmem_max
+SOCKET_TOS       = 0xB8     # DSCP Expedited Forwarding, marks V2V traffic as low-latency
+BUSY_POLL_USEC   = 50       # Microseconds a blocking receive spins on the device queue before sleeping
+
+# Resolved (host, port) -> socket address pairs, destinations are looked up once rather than on every sendto
+_ADDRINFO_CACHE = {}
+
+
+def resolve_address(address: tuple) -> tuple:
+    """ Resolve a (host, port) destination to the socket address used for UDP transmissions. """
+    if address not in _ADDRINFO_CACHE:
+        _ADDRINFO_CACHE[address] = getaddrinfo(address[0], address[1], AF_INET, SOCK_DGRAM)[0][4]
+    return _ADDRINFO_CACHE[address]
 
 
 class VehicleSensor:
@@ -37,21 +68,19 @@ class VehicleSensor:
             random.uniform(-MAX_TRAVEL_DELTA, MAX_TRAVEL_DELTA)
         )
 
-        # Generate ending position that is nofurther away than max travel delta
+        # Generate ending position that is nofurther away than max travel delta, wrapping across the antimeridian
+        # and stopping at the poles rather than jumping to the far side of the globe
         self.gps_final = Coordinates(
-            longitude=(self.gps_initial.longitude + delta_long) % (180 if self.gps_initial.longitude > 0 else -180),
-            latitude=(self.gps_initial.latitude + delta_lat) % (90 if self.gps_initial.latitude > 0 else -90)
+            longitude=(self.gps_initial.longitude + delta_long + 180) % 360 - 180,
+            latitude=max(-90.0, min(90.0, self.gps_initial.latitude + delta_lat))
         )
 
         # Brake and gas pedals determine acceleration, their values are mutually exclusive
+        # The sign picks the pedal and the magnitude its depth, the unused pedal clamps to zero without branching
         pedal_choice = random.uniform(-100, 100)
-        self.brake_control, self.gas_throttle, self.acceleration = (0, 0, 0)
-        if pedal_choice < 0:
-            self.brake_control = abs(pedal_choice)
-            self.acceleration = MAX_ACCELERATION * (self.brake_control / 100)
-        else:
-            self.gas_throttle = pedal_choice
-            self.acceleration = MAX_ACCELERATION * (self.gas_throttle / 100)
+        self.brake_control = max(-pedal_choice, 0.0)
+        self.gas_throttle = max(pedal_choice, 0.0)
+        self.acceleration = MAX_ACCELERATION * (abs(pedal_choice) / 100)
 
         # Generate a random starting velocity from a tightened statistical curve
         self.velocity = random.betavariate(3, 8) * MAX_VELOCITY
@@ -64,8 +93,7 @@ class VehicleSensor:
 
     def _pedal_change(self):
         # Decide if inputs should change in this iteration
-        should_interact = random.choices([True, False], [0.15, 0.97])
-        if should_interact:
+        if random.random() < PEDAL_CHANCE:
             # Brake and gas pedals determine acceleration, their values are mutually exclusive
             pedal_value = random.uniform(0, 100)
             pedal_choice = random.uniform(0, 20)
@@ -92,32 +120,52 @@ class Vehicle:
         # Define an AF_INET UDP socket for data transmission and reception
         self.socket = socket(AF_INET, SOCK_DGRAM)
 
+        # Size kernel buffers so bursts are absorbed instead of dropped, and request low-latency queueing
+        self.socket.setsockopt(SOL_SOCKET, SO_SNDBUF, SOCKET_BUFFER)
+        self.socket.setsockopt(SOL_SOCKET, SO_RCVBUF, SOCKET_BUFFER)
+        self.socket.setsockopt(IPPROTO_IP, IP_TOS, SOCKET_TOS)
+
+        # Poll the device queue instead of waiting on the interrupt, raising either option above the
+        # net.core.busy_read sysctl needs CAP_NET_ADMIN, so an unprivileged vehicle keeps the default path
+        if SO_BUSY_POLL is not None:
+            try:
+                self.socket.setsockopt(SOL_SOCKET, SO_BUSY_POLL, BUSY_POLL_USEC)
+                self.socket.setsockopt(SOL_SOCKET, SO_PREFER_BUSY_POLL, 1)
+            except OSError as e:
+                logger.debug("Busy polling unavailable: %s", e)
+
         # Vehicle sensor data and packet instance
         self.data: VehicleSensor
         self.packet: Packet
 
         # Print parameters to console for a general vehicle until we specialize
-        print(f"VANET Fleet\nVehicle: {vehicle_type}\nIP Address: {address}\n")
+        logger.info("VANET Fleet\nVehicle: %s\nIP Address: %s\n", vehicle_type, address)
 
 
 class LeadVehicle(Vehicle):
     def __init__(self, address: str, followers: List[tuple]):
         super().__init__(vehicle_type="Lead", address=address)
 
-        # Set socket to non-blocking to allow for sending without waiting for acknowledgement
-        self.socket.settimeout(1)
+        # Set socket to non-blocking to allow for sending without waiting for acknowledgement, readiness is polled
+        self.socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
 
         # Global flags
         self.destination_reached = False
         self.polls = 0
-        self.followers = followers
+        self.followers = [resolve_address(follower) for follower in followers]
         self.sequence = 1
 
+        # Assume only a single fleet vehicle for now, connecting fixes the destination once instead of per send
+        # and has the kernel drop datagrams from any other peer before they reach the acknowledgement loop
+        self.socket.connect(self.followers[0])
+
         # Vehicle sensor data and packet instance
         self.sensor = VehicleSensor()
         self.packet = Packet(
             sequence_number=self.sequence,
-            source_address=IPv4Address(address),
+            source_address=address,
             gps_position=self.sensor.gps_instant,
             velocity=self.sensor.velocity,
             acceleration=self.sensor.acceleration,
@@ -125,36 +173,63 @@ class LeadVehicle(Vehicle):
             gas_throttle=self.sensor.gas_throttle
         )
 
+        # Outgoing packets are serialized into the same buffer every cycle instead of allocating new bytes
+        self._send_buffer = bytearray(MAX_PACKET_SIZE)
+        self._send_view = memoryview(self._send_buffer)
+
+        # Acknowledgements are received into a single reused buffer, one byte larger so oversized datagrams show
+        self._ack_buffer = bytearray(ACK_FORMAT.size + 1)
+
         # Print parameters to console and back an initialized vehicle
-        print(f"Coordinates:\n\tStart:\t{self.sensor.gps_initial}\n\tEnd:\t{self.sensor.gps_final}\n")
+        logger.info("Coordinates:\n\tStart:\t%s\n\tEnd:\t%s\n", self.sensor.gps_initial, self.sensor.gps_final)
 
         self._drive(sample_rate=10)
 
     def _drive(self, *, sample_rate: int):
-        # Generate driving data if lead vehicle
-        sleep_rate = sample_rate ^ -1
+        # Transmission period in integer nanoseconds, every delay below stays in ns and is only converted for display
+        period_ns = 1_000_000_000 // sample_rate
 
-        # Assume only a single fleet vehicle for now
-        follower = self.followers[0]
         acknowledgements = 0
 
+        # Transmissions are scheduled on fixed ticks from the first broadcast, so sleep overshoot does not accumulate
+        next_tick_ns = time.monotonic_ns()
+
         # Lead driver for n-cycles, start transmitting
         while not self.destination_reached:
             # Obtain new packet
-            new_packet = self.packet.get_packet()
+            new_packet = self._send_view[:self.packet.pack_into(self._send_buffer)]
 
             # Start broadcasting blindly to clients
-            print(f"Broadcasted Sequence #{self.sequence}. Waiting 100ms before next retransmission.")
-            print(f"DATA: {bytes.decode(new_packet, 'utf-8')}")
-            self.socket.sendto(new_packet, follower)
-            response_msg, server_address = self.socket.recvfrom(8)
-            decoded_data = bytes.decode(response_msg, 'utf-8')
-
-            # Verify server connection
-            timestamp_received = -1.0
-            if "ACK" in decoded_data:
-                print(f"Sequence #{decoded_data.split(' ')[1]} ACK'ed by {server_address[0]}")
-                timestamp_received = datetime.datetime.utcnow().timestamp()
+            logger.debug("Broadcasted Sequence #%d. Waiting %dms before next retransmission.", self.sequence, period_ns // 1_000_000)
+            logger.debug("DATA: %s", self.packet)
+            self._send(new_packet)
+            broadcast_ns = time.monotonic_ns()
+
+            # Verify server connection, reading datagrams until this sequence is acknowledged or the deadline passes
+            received_ns = None
+            deadline_ns = broadcast_ns + ACK_TIMEOUT * 1_000_000_000
+            while received_ns is None:
+                remaining_ns = deadline_ns - time.monotonic_ns()
+                if remaining_ns <= 0 or not self.selector.select(timeout=remaining_ns / 1_000_000_000):
+                    logger.warning("Sequence #%d was not acknowledged within %ss.", self.sequence, ACK_TIMEOUT)
+                    break
+                try:
+                    nbytes, server_address = self.socket.recvfrom_into(self._ack_buffer)
+                except ConnectionRefusedError:
+                    # Connected sockets surface ICMP port unreachable, nothing is listening for this sequence
+                    logger.warning("Sequence #%d was refused by %s.", self.sequence, self.followers[0][0])
+                    break
+
+                # Acknowledgements are matched and read as bytes in place without decoding
+                if nbytes != ACK_FORMAT.size or not self._ack_buffer.startswith(ACK_MAGIC):
+                    continue
+                _, acknowledged_sequence = ACK_FORMAT.unpack_from(self._ack_buffer)
+                if acknowledged_sequence != self.sequence:
+                    # Late acknowledgement for an earlier sequence, it must not be counted for this one
+                    logger.debug("Discarded stale ACK #%d from %s", acknowledged_sequence, server_address[0])
+                    continue
+                logger.debug("Sequence #%d ACK'ed by %s", acknowledged_sequence, server_address[0])
+                received_ns = time.monotonic_ns()
                 acknowledgements += 1
 
             # For testing, only perform a certain number of updates before ending transmissions
@@ -173,13 +248,39 @@ class LeadVehicle(Vehicle):
             if self.polls >= 30:
                 self.destination_reached = True
 
-            # Sleep for 100 milliseconds
-            transmission_delay = timestamp_received - self.packet.timestamp
-            if transmission_delay < 0.1 and timestamp_received != -1:
-                print(f"Acknowledgment received {int(transmission_delay * 1000)}ms after broadcast. Waiting an additional {100 - int(transmission_delay * 1000)}ms to send another transmission.\n")
-                time.sleep(0.1 - transmission_delay)
-            elif transmission_delay > 0.1:
-                print(f"Acknowledgement received over 100ms after broadcast ({int(transmission_delay * 1000)}ms). Sending next packet immediately.\n")
+            # Sleep until the next tick, delays are measured on the monotonic clock so wall clock steps cannot skew them
+            next_tick_ns += period_ns
+            excess_ns = next_tick_ns - time.monotonic_ns()
+            if excess_ns > 0:
+                if received_ns is not None:
+                    logger.debug("Acknowledgment received %dms after broadcast. Waiting an additional %dms to send another transmission.\n", (received_ns - broadcast_ns) // 1_000_000, excess_ns // 1_000_000)
+                time.sleep(excess_ns / 1_000_000_000)
+            else:
+                # Overran the period, restart the schedule from now rather than bursting to catch up on missed ticks
+                if received_ns is not None:
+                    logger.debug("Acknowledgement received over %dms after broadcast (%dms). Sending next packet immediately.\n", period_ns // 1_000_000, (received_ns - broadcast_ns) // 1_000_000)
+                next_tick_ns = time.monotonic_ns()
+
+    def _send(self, data):
+        # UDP sockets are almost always writable, so send first and only wait for room when the kernel pushes back
+        try:
+            try:
+                self.socket.send(data)
+            except BlockingIOError:
+                self.selector.modify(self.socket, selectors.EVENT_WRITE)
+                try:
+                    writable = self.selector.select(timeout=ACK_TIMEOUT)
+                finally:
+                    self.selector.modify(self.socket, selectors.EVENT_READ)
+                if not writable:
+                    raise
+                self.socket.send(data)
+        except BlockingIOError:
+            # The send buffer never drained, drop this transmission and let the acknowledgement wait time out
+            logger.warning("Sequence #%d was dropped, the socket was not writable within %ss.", self.sequence, ACK_TIMEOUT)
+        except ConnectionRefusedError:
+            # A refusal from an earlier transmission is reported here, the acknowledgement wait then times out
+            logger.warning("Sequence #%d could not be sent, %s refused the previous transmission.", self.sequence, self.followers[0][0])
 
 
 class FleetVehicle(Vehicle):
@@ -189,6 +290,14 @@ class FleetVehicle(Vehicle):
         # Bind to address for listening
         self.socket.bind(address)
 
+        # Incoming packets are received into a single reused buffer and parsed through a view of it, the extra byte
+        # keeps an oversized datagram from being truncated into a packet-sized one that passes the length check
+        self._receive_buffer = bytearray(MAX_PACKET_SIZE + 1)
+        self._receive_view = memoryview(self._receive_buffer)
+
+        # Acknowledgements are packed into a single reused buffer, only the sequence changes per packet
+        self._ack_buffer = bytearray(ACK_FORMAT.size)
+
         # Set to following mode
         self._follow()
 
@@ -197,12 +306,20 @@ class FleetVehicle(Vehicle):
         num_pkts = 0
         while not num_pkts >= 30:
             # Await packet from client to generate new sensor values
-            incoming_data, client_address = self.socket.recvfrom(300)
+            nbytes, client_address = self.socket.recvfrom_into(self._receive_buffer)
+            incoming_data = self._receive_view[:nbytes]
+
+            # Drop anything that is not a VANET packet before handing it to the parser
+            if incoming_data[:len(PACKET_MAGIC)] != PACKET_MAGIC:
+                logger.warning("Discarded non-packet datagram from %s.", client_address[0])
+                continue
 
             # Attempt to parse incoming packet
             new_packet = Packet.interpret_packet(incoming_data)
             if new_packet:
-                print(f"Packet #{new_packet.sequence_number} received from {client_address[0]}. Sending ACK #{new_packet.sequence_number}.")
-                print(f"{new_packet.dict()}\n")
-                self.socket.sendto(bytes(f"ACK {new_packet.sequence_number}", 'utf-8'), client_address)
+                logger.debug("Packet #%d received from %s. Sending ACK #%d.", new_packet.sequence_number, client_address[0], new_packet.sequence_number)
+                logger.debug("%s\n", new_packet)
+                ACK_FORMAT.pack_into(self._ack_buffer, 0, ACK_MAGIC, new_packet.sequence_number)
+                self.socket.sendto(self._ack_buffer, client_address)
+                new_packet.release()
                 num_pkts += 1